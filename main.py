@@ -5,6 +5,7 @@ import torchvision
 import os
 import numpy as np
 import tqdm
+from concurrent.futures import ThreadPoolExecutor, wait
 
 from utils.models import Classifier
 from torch.utils.tensorboard import SummaryWriter
@@ -31,6 +32,7 @@ def FLAGS():
     # loader and device options
     parser.add_argument("--device", default="cuda:0")
     parser.add_argument("--num_workers", type=int, default=4)
+    parser.add_argument("--prefetch_factor", type=int, default=4)
     parser.add_argument("--pin_memory", type=bool, default=True)
     parser.add_argument("--batch_size", type=int, default=4)
     parser.add_argument("--accumulate_grad_over", type=int, default=4)
@@ -38,10 +40,12 @@ def FLAGS():
 
     parser.add_argument("--num_epochs", type=int, default=30)
     parser.add_argument("--save_every_n_epochs", type=int, default=5)
+    parser.add_argument("--viz_every_n_epochs", type=int, default=5)
+    parser.add_argument("--flush_every_n_epochs", type=int, default=5)
     
     parser.add_argument("--continue_from", default=None)
 
-    parser.add_argument("--use_hp", default=False)
+    parser.add_argument("--precision", default="fp32", choices=["fp32", "fp16", "bf16"])
 
     flags = parser.parse_args()
 
@@ -58,7 +62,7 @@ def FLAGS():
         f.write(f"accumulate_grad_over: {flags.accumulate_grad_over}\n")
         f.write(f"lr: {flags.lr}\n")
         f.write(f"device: {flags.device}\n")
-        f.write(f"use_hp: {flags.use_hp}\n")
+        f.write(f"precision: {flags.precision}\n")
         f.write(f"log_dir: {flags.log_dir}\n")
         f.write(f"training_dataset: {flags.training_dataset}\n")
         f.write(f"validation_dataset: {flags.validation_dataset}\n")
@@ -66,28 +70,61 @@ def FLAGS():
 
     return flags
 
-def percentile(t, q):
+def percentile_pair(t, q_lo, q_hi):
+    # both percentiles lie in the tails, so select the few smallest and largest values
+    # on t's device instead of sorting the whole representation
     B, C, H, W = t.shape
-    k = 1 + round(.01 * float(q) * (C * H * W - 1))
-    result = t.view(B, -1).kthvalue(k).values
-    return result[:,None,None,None]
+    N = C * H * W
+    flat = t.view(B, -1)
+    k_lo = 1 + round(.01 * float(q_lo) * (N - 1))
+    k_hi = 1 + round(.01 * float(q_hi) * (N - 1))
+    lo = flat.topk(k_lo, dim=1, largest=False).values[:, -1]
+    hi = flat.topk(N - k_hi + 1, dim=1, largest=True).values[:, -1]
+    return lo[:,None,None,None], hi[:,None,None,None]
 
 def create_image(representation):
     B, C, H, W = representation.shape
     representation = representation.view(B, 3, C // 3, H, W).sum(2)
 
-    # do robust min max norm
-    representation = representation.detach().cpu().float()
-    robust_max_vals = percentile(representation, 99)
-    robust_min_vals = percentile(representation, 1)
+    # do robust min max norm on the gpu, only the final grid is moved to the cpu
+    representation = representation.detach().float()
+    robust_min_vals, robust_max_vals = percentile_pair(representation, 1, 99)
 
-    representation = (representation - robust_min_vals)/(robust_max_vals - robust_min_vals)
-    representation = torch.clamp(255*representation, 0, 255).byte()
+    # the channel sum is a fresh tensor, so normalize it in place to avoid float intermediates
+    representation.sub_(robust_min_vals).div_(robust_max_vals - robust_min_vals + 1e-8)
+    representation = representation.mul_(255).clamp_(0, 255).byte()
 
-    representation = torchvision.utils.make_grid(representation)
+    representation = torchvision.utils.make_grid(representation).cpu()
 
     return representation
 
+def pinned_cpu_state_dict(state_dict):
+    pin_memory = torch.cuda.is_available()
+    return {k: torch.empty(v.shape, dtype=v.dtype, device="cpu", pin_memory=pin_memory)
+            for k, v in state_dict.items()}
+
+def copy_state_dict(cpu_state_dict, state_dict):
+    # copy into pinned memory with dma, then wait until all copies have landed on every
+    # device the weights live on, which need not be the current cuda device
+    for k, v in state_dict.items():
+        cpu_state_dict[k].copy_(v.detach(), non_blocking=True)
+    for device in {v.device for v in state_dict.values() if v.is_cuda}:
+        torch.cuda.synchronize(device)
+
+def save_checkpoint_async(executor, cpu_state_dict, path, **kwargs):
+    # weights live in a cpu copy, so the background write does not race with the optimizer
+    return executor.submit(torch.save, {"state_dict": cpu_state_dict, **kwargs}, path)
+
+def drain_futures(futures):
+    # raise errors of finished writes and only keep the ones still running
+    running = []
+    for future in futures:
+        if future.done():
+            future.result()
+        else:
+            running.append(future)
+    return running
+
 
 if __name__ == '__main__':
     flags = FLAGS()
@@ -97,6 +134,13 @@ if __name__ == '__main__':
     torch.manual_seed(0)
     np.random.seed(0)
 
+    # allow tf32 tensor cores and let cudnn autotune the convolutions, inputs to
+    # the classifier are cropped to a fixed resolution so only the batch size varies
+    torch.backends.cuda.matmul.allow_tf32 = True
+    torch.backends.cudnn.allow_tf32 = True
+    torch.backends.cudnn.benchmark = True
+    torch.backends.cudnn.deterministic = False
+
     # datasets, add augmentation to training set
     training_dataset = NCaltech101(flags.training_dataset, augmentation=True)
     validation_dataset = NCaltech101(flags.validation_dataset, classes=training_dataset.classes)
@@ -106,6 +150,7 @@ if __name__ == '__main__':
     training_loader = Loader(training_dataset, flags, device=flags.device)
     validation_loader = Loader(validation_dataset, flags, device=flags.device)
     testing_loader = Loader(testing_dataset, flags, device=flags.device)
+    n_train, n_val, n_test = len(training_loader), len(validation_loader), len(testing_loader)
 
     # model, and put to device
     model = Classifier(num_classes=len(training_dataset.classes))
@@ -117,7 +162,7 @@ if __name__ == '__main__':
         model.load_state_dict(ckpt['state_dict'])
         iteration = ckpt['iteration']
         min_validation_loss = ckpt['min_val_loss']
-        start_epoch = round(iteration / len(training_loader))
+        start_epoch = round(iteration / n_train)
 
     else:
         iteration = 0
@@ -125,148 +170,192 @@ if __name__ == '__main__':
         start_epoch = 0
     
     model = model.to(flags.device)
-    if flags.use_hp:
-        model = model.half()
+
+    # compile the resnet in place, the quantization layer depends on the event data
+    # (unique batch indices, per sample loops) and would only cause graph breaks
+    model.classifier.compile(mode="max-autotune")
+
+    # mixed precision, weights stay in fp32 and only fp16 needs loss scaling
+    device_type = torch.device(flags.device).type
+    amp_dtype = torch.bfloat16 if flags.precision == "bf16" else torch.float16
+    use_amp = flags.precision != "fp32"
+    scaler = torch.cuda.amp.GradScaler(enabled=(flags.precision == "fp16"))
 
     # optimizer and lr scheduler
-    eps = 1e-4 if flags.use_hp else 1e-8
-    optimizer = torch.optim.Adam(model.parameters(), lr=flags.lr, eps=eps)
+    # fused adam updates all parameters in a single kernel, older torch versions only have foreach
+    try:
+        optimizer = torch.optim.Adam(model.parameters(), lr=flags.lr, fused=(device_type == "cuda"))
+    except TypeError:
+        optimizer = torch.optim.Adam(model.parameters(), lr=flags.lr, foreach=True)
     lr_scheduler = torch.optim.lr_scheduler.ExponentialLR(optimizer, 0.5)
 
     os.makedirs(flags.log_dir, exist_ok=True)
     writer = SummaryWriter(flags.log_dir)
 
+    # checkpoints are written on a background thread while training continues
+    ckpt_executor = ThreadPoolExecutor(max_workers=1)
+    ckpt_futures = []
+    cpu_state_dict = pinned_cpu_state_dict(model.state_dict())
+
 
     for i in range(flags.num_epochs):
         if i < start_epoch:
             continue
 
+        visualize = i % flags.viz_every_n_epochs == 0
+
         ######### Training #########
-        sum_accuracy = 0
-        sum_loss = 0
+        sum_accuracy = torch.zeros((), device=flags.device)
+        sum_loss = torch.zeros((), device=flags.device)
+        representation = None
+        pending_grads = False
 
         model = model.train()
         print(f"Training step [{i:3d}/{flags.num_epochs:3d}]")
         for j, (events, labels) in tqdm.tqdm(
-            enumerate(training_loader), total=len(training_loader)):
-            if events.size == 0:
-                continue
-            
-            if j % flags.accumulate_grad_over == 0:
-                optimizer.zero_grad()
-
-            pred_labels, representation = model(events, test=True, use_hp=flags.use_hp)
-            loss, accuracy = cross_entropy_loss_and_accuracy(
-                pred_labels, labels)
+            enumerate(training_loader), total=n_train):
+            with torch.autocast(device_type, dtype=amp_dtype, enabled=use_amp):
+                pred_labels, vox = model(events, test=True)
+                loss, accuracy = cross_entropy_loss_and_accuracy(
+                    pred_labels, labels)
 
             loss /= flags.accumulate_grad_over
 
-            loss.backward()
+            scaler.scale(loss).backward()
+            pending_grads = True
 
             if (j + 1) % flags.accumulate_grad_over == 0:
-                optimizer.step()
+                scaler.step(optimizer)
+                scaler.update()
+                optimizer.zero_grad(set_to_none=True)
+                pending_grads = False
 
-            sum_accuracy += accuracy.detach()
-            sum_loss += loss.detach()
+            sum_accuracy.add_(accuracy.detach())
+            sum_loss.add_(loss.detach())
 
             iteration += 1
 
-            del events, labels, pred_labels, loss, accuracy
+            # keep the representation of the latest batch, so the last one is left after the loop,
+            # and drop the voxel grid so it is not alive during the next forward pass
+            if visualize:
+                representation = vox.detach()
+            del vox
+
+        # apply the gradients of a partial accumulation, so they do not leak into the next epoch
+        if pending_grads:
+            scaler.step(optimizer)
+            scaler.update()
+            optimizer.zero_grad(set_to_none=True)
 
         if i % 10 == 9:
             lr_scheduler.step()
 
-        training_loss = sum_loss.item() / len(training_loader)
-        training_accuracy = sum_accuracy.item() / len(training_loader)
+        training_loss, training_accuracy = torch.stack([sum_loss, sum_accuracy]).div_(n_train).tolist()
         print(f"Training Iteration {iteration:5d}  Loss {training_loss:.4f}  Accuracy {training_accuracy:.4f}")
 
         writer.add_scalar("training/accuracy", training_accuracy, iteration)
         writer.add_scalar("training/loss", training_loss, iteration)
 
-        representation_vizualization = create_image(representation)
-        writer.add_image("training/representation",
-                         representation_vizualization, iteration)
+        if visualize and representation is not None:
+            representation_vizualization = create_image(representation)
+            writer.add_image("training/representation",
+                             representation_vizualization, iteration)
+        del representation
 
         
         ######### Validation #########
-        sum_accuracy = 0
-        sum_loss = 0
+        sum_accuracy = torch.zeros((), device=flags.device)
+        sum_loss = torch.zeros((), device=flags.device)
+        representation = None
         model = model.eval()
 
         print(f"Validation step [{i:3d}/{flags.num_epochs:3d}]")
-        for events, labels in tqdm.tqdm(validation_loader):
-            if events.size == 0:
-                continue
-
-            with torch.no_grad():
-                pred_labels, representation = model(events, test=True, use_hp=flags.use_hp)
+        for events, labels in tqdm.tqdm(validation_loader, total=n_val):
+            with torch.inference_mode(), torch.autocast(device_type, dtype=amp_dtype, enabled=use_amp):
+                pred_labels, vox = model(events, test=True)
                 loss, accuracy = cross_entropy_loss_and_accuracy(pred_labels, labels)
 
-            sum_accuracy += accuracy.detach()
-            sum_loss += loss.detach()
+            sum_accuracy.add_(accuracy.detach())
+            sum_loss.add_(loss.detach())
 
-            del events, labels, pred_labels, loss, accuracy
+            if visualize:
+                representation = vox
+            del vox
 
-        validation_loss = sum_loss.item() / len(validation_loader)
-        validation_accuracy = sum_accuracy.item() / len(validation_loader)
+        validation_loss, validation_accuracy = torch.stack([sum_loss, sum_accuracy]).div_(n_val).tolist()
 
         writer.add_scalar("validation/accuracy", validation_accuracy, iteration)
         writer.add_scalar("validation/loss", validation_loss, iteration)
 
         # visualize representation
-        representation_vizualization = create_image(representation)
-        writer.add_image("validation/representation", representation_vizualization, iteration)
+        if visualize and representation is not None:
+            representation_vizualization = create_image(representation)
+            writer.add_image("validation/representation", representation_vizualization, iteration)
+        del representation
 
         print(f"Validation Loss {validation_loss:.4f}  Accuracy {validation_accuracy:.4f}")
 
-        if validation_loss < min_validation_loss:
-            min_validation_loss = validation_loss
-            state_dict = model.state_dict()
+        is_best = validation_loss < min_validation_loss
+        save_checkpoint = i % flags.save_every_n_epochs == 0
 
-            torch.save({
-                "state_dict": state_dict,
-                "min_val_loss": min_validation_loss,
-                "iteration": iteration
-            }, os.path.join(flags.log_dir, "model_best.pth"))
+        if is_best or save_checkpoint:
+            # pending writes still read from the cpu copy, let them finish before overwriting it
+            wait(ckpt_futures)
+            ckpt_futures = drain_futures(ckpt_futures)
+            copy_state_dict(cpu_state_dict, model.state_dict())
+
+        if is_best:
+            min_validation_loss = validation_loss
+            ckpt_futures.append(save_checkpoint_async(
+                ckpt_executor, cpu_state_dict, os.path.join(flags.log_dir, "model_best.pth"),
+                min_val_loss=min_validation_loss, iteration=iteration))
             print("New best at ", validation_loss)
 
-        if i % flags.save_every_n_epochs == 0:
-            state_dict = model.state_dict()
-            torch.save({
-                "state_dict": state_dict,
-                "min_val_loss": min_validation_loss,
-                "iteration": iteration
-            }, os.path.join(flags.log_dir, "checkpoint_%05d_%.4f.pth" % (iteration, min_validation_loss)))
+        if save_checkpoint:
+            ckpt_futures.append(save_checkpoint_async(
+                ckpt_executor, cpu_state_dict,
+                os.path.join(flags.log_dir, "checkpoint_%05d_%.4f.pth" % (iteration, min_validation_loss)),
+                min_val_loss=min_validation_loss, iteration=iteration))
+
+        ckpt_futures = drain_futures(ckpt_futures)
 
 
         ######### Testing #########
-        sum_accuracy = 0
-        sum_loss = 0
+        sum_accuracy = torch.zeros((), device=flags.device)
+        sum_loss = torch.zeros((), device=flags.device)
+        representation = None
         model = model.eval()
 
         print(f"Testing step [{i:3d}/{flags.num_epochs:3d}]")
-        for events, labels in tqdm.tqdm(testing_loader):
-            if events.size == 0:
-                continue
-
-            with torch.no_grad():
-                pred_labels, representation = model(events, test=True, use_hp=flags.use_hp)
+        for events, labels in tqdm.tqdm(testing_loader, total=n_test):
+            with torch.inference_mode(), torch.autocast(device_type, dtype=amp_dtype, enabled=use_amp):
+                pred_labels, vox = model(events, test=True)
                 loss, accuracy = cross_entropy_loss_and_accuracy(pred_labels, labels)
 
-            sum_accuracy += accuracy.detach()
-            sum_loss += loss.detach()
+            sum_accuracy.add_(accuracy.detach())
+            sum_loss.add_(loss.detach())
 
-            del events, labels, pred_labels, loss, accuracy
+            if visualize:
+                representation = vox
+            del vox
 
-        testing_loss = sum_loss.item() / len(testing_loader)
-        testing_accuracy = sum_accuracy.item() / len(testing_loader)
+        testing_loss, testing_accuracy = torch.stack([sum_loss, sum_accuracy]).div_(n_test).tolist()
 
         writer.add_scalar("testing/accuracy", testing_accuracy, iteration)
         writer.add_scalar("testing/loss", testing_loss, iteration)
 
         # visualize representation
-        representation_vizualization = create_image(representation)
-        writer.add_image("testing/representation", representation_vizualization, iteration)
+        if visualize and representation is not None:
+            representation_vizualization = create_image(representation)
+            writer.add_image("testing/representation", representation_vizualization, iteration)
+        del representation
 
         print(f"Testing Loss {testing_loss:.4f}  Accuracy {testing_accuracy:.4f}")
-        writer.flush()
+        if i % flags.flush_every_n_epochs == 0:
+            writer.flush()
+
+    writer.close()
+
+    # wait for outstanding checkpoint writes before exiting
+    ckpt_executor.shutdown(wait=True)
+    drain_futures(ckpt_futures)
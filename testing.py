@@ -19,6 +19,7 @@ def FLAGS():
     parser.add_argument("--test_dataset", default="", required=True)
     parser.add_argument("--device", default="cuda:0")
     parser.add_argument("--num_workers", type=int, default=4)
+    parser.add_argument("--prefetch_factor", type=int, default=4)
     parser.add_argument("--batch_size", type=int, default=4)
     parser.add_argument("--pin_memory", type=bool, default=True)
 
@@ -58,7 +59,7 @@ if __name__ == '__main__':
 
     print("Test step")
     for events, labels in tqdm.tqdm(test_loader):
-        with torch.no_grad():
+        with torch.inference_mode():
             pred_labels, _ = model(events, test=True)
             loss, accuracy = cross_entropy_loss_and_accuracy(pred_labels, labels)
 
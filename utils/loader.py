@@ -9,27 +9,89 @@ class Loader:
         self.device = device
         split_indices = list(range(len(dataset)))
         sampler = torch.utils.data.sampler.SubsetRandomSampler(split_indices)
+
+        # keep workers alive across epochs, these options require worker processes
+        worker_kwargs = {}
+        if flags.num_workers > 0:
+            worker_kwargs = dict(persistent_workers=True, prefetch_factor=flags.prefetch_factor)
+
         self.loader = torch.utils.data.DataLoader(dataset, batch_size=flags.batch_size, sampler=sampler,
                                              num_workers=flags.num_workers, pin_memory=flags.pin_memory,
-                                             collate_fn=collate_events)
+                                             collate_fn=collate_events, worker_init_fn=seed_worker,
+                                             **worker_kwargs)
 
     def __iter__(self):
-        for data in self.loader:
-            data = [d.to(self.device) for d in data]
+        # collate_events returns None for batches without any events
+        batches = (data for data in self.loader if data is not None)
+
+        if torch.device(self.device).type == "cuda":
+            yield from CUDAPrefetcher(batches, self.device)
+            return
+
+        for data in batches:
+            # batches come out of pinned memory, copy without blocking the host
+            data = [d.to(self.device, non_blocking=True) for d in data]
             yield data
 
     def __len__(self):
         return len(self.loader)
 
 
+class CUDAPrefetcher:
+    """
+    Copies the next batch to the gpu on a side stream while the current one is processed.
+    """
+    def __init__(self, loader, device):
+        self.loader = iter(loader)
+        self.device = device
+        self.stream = torch.cuda.Stream(device=device)
+        self.preload()
+
+    def preload(self):
+        try:
+            data = next(self.loader)
+        except StopIteration:
+            self.next_data = None
+            return
+
+        with torch.cuda.stream(self.stream):
+            self.next_data = [d.to(self.device, non_blocking=True) for d in data]
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        current_stream = torch.cuda.current_stream(self.device)
+        current_stream.wait_stream(self.stream)
+
+        data = self.next_data
+        if data is None:
+            raise StopIteration
+
+        # memory was allocated on the side stream, mark it as in use by the compute stream
+        for d in data:
+            d.record_stream(current_stream)
+
+        self.preload()
+        return data
+
+
+def seed_worker(worker_id):
+    # torch seeds every worker differently, derive the numpy seed used for augmentation from it
+    np.random.seed(torch.initial_seed() % 2**32)
+
+
 def collate_events(data):
+    # drop empty samples here, so that the training loop never sees them
+    data = [(d, label) for (d, label) in data if d.size > 0]
+    if len(data) == 0:
+        return None
+
     max_events = np.max([len(ev) for (ev, _) in data])
     labels = []
     events = np.zeros((len(data), max_events, 5), dtype=np.float32)
     events[...,-1] = -1
     for i, (d, label) in enumerate(data):
-        if d.size == 0:
-            continue
         labels.append(label)
         ev = np.concatenate([d, i*np.ones((len(d),1), dtype=np.float32)],1)
         events[i, :d.shape[0], :] = ev